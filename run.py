@@ -1,20 +1,25 @@
-import flask
+import faulthandler
+import functools
+import math
 import numpy as np
 import os
 import signal
+import time
+import warnings
 
 from builtins import print as bprint
-from gevent import event, pywsgi, signal
-from pathlib import Path
-from spatialmath import SE3, UnitQuaternion
+from gevent import event
+from gevent import signal as gsignal
 
 print("STARTING RUN.PY IN BENCHBOT_SIM_OMNI")
 
-DEFAULT_POSE = np.array([1, 0, 0, 0, 0, 0, 0])
+DEFAULT_POSE = np.array([1, 0, 0, 0, 0, 0, 0], dtype=np.float64)
+_POSE_STRIP_TABLE = str.maketrans('', '', '[]')
 
 DIRTY_EPSILON_DIST = 1
 DIRTY_EPSILON_YAW = 2
 DIRTY_FILE = '/tmp/benchbot_dirty'
+_DIRTY_FD_FLAGS = os.O_WRONLY | os.O_CREAT
 
 MAP_PRIM_PATH = '/env'
 ROBOT_NAME = 'robot'
@@ -27,26 +32,44 @@ ROBOT_COMPONENTS = {
     'tf_sensors': '%s/ROS_Carter_Sensors_Broadcaster' % ROBOT_PRIM_PATH,
     'tf': '%s/ROS_Carter_Broadcaster' % ROBOT_PRIM_PATH
 }
+_ROBOT_COMPONENT_PATHS = tuple(ROBOT_COMPONENTS.values())
+SIM_HZ = 60
 UPDATE_DELAY_SECS = 3.0
 
+# Phases of the SIM_HZ tick cycle at which each check runs, as bitmaps
+_DIRTY_PHASES = sum(1 << i for i in range(0, SIM_HZ, SIM_HZ // 10))
+_COLLIDED_PHASES = 1
 
-def _dc_tf_to_SE3(tf):
-    r = np.array(tf.r)
-    return SE3(np.array(tf.p)) * UnitQuaternion(r[3], r[0:3]).SE3()
 
-
-def _to_SE3(pose):
-    return SE3(pose[4::]) * UnitQuaternion(pose[0], pose[1:4]).SE3()
-
-
-def disable_component(prop_path):
-    from omni.kit.commands import execute
-    from pxr import Sdf
-    print("DISABLING '%s.enabled'" % prop_path)
-    execute("ChangeProperty",
-            prop_path=Sdf.Path("%s.enabled" % prop_path),
-            value=False,
-            prev=None)
+def _env_flag(name, default):
+    v = os.environ.get(name)
+    if v is None:
+        return default
+    if v.strip().lower() in ('1', 'true', 'yes', 'on'):
+        return True
+    if v.strip().lower() in ('0', 'false', 'no', 'off'):
+        return False
+    raise ValueError("Invalid value '%s' for %s (expected 1/0, true/false, "
+                     "yes/no, or on/off)" % (v, name))
+
+
+def _parse_pose(pose_str):
+    # Older NumPy stops at the first bad token with only a DeprecationWarning
+    # (and tolerates a trailing separator), so escalate that and check exactly
+    # 7 values were given
+    s = pose_str.translate(_POSE_STRIP_TABLE)
+    with warnings.catch_warnings():
+        warnings.simplefilter('error', DeprecationWarning)
+        try:
+            p = np.fromstring(s, sep=',')
+        except (DeprecationWarning, ValueError) as e:
+            raise ValueError("Invalid pose '%s': %s" % (pose_str, e))
+    if p.size != 7 or s.count(',') != 6:
+        raise ValueError("Invalid pose '%s': expected 7 values" % pose_str)
+    if not np.isfinite(p).all() or np.linalg.norm(p[:4]) <= 1e-9:
+        raise ValueError("Invalid pose '%s': values must be finite, with a "
+                         "non-zero quaternion" % pose_str)
+    return p
 
 
 def print(*args, **kwargs):
@@ -72,20 +95,157 @@ class SimulatorDaemon:
         self._map_usd = None
         self._robot_usd = None
         self._start_pose = None
+        self._start_pose_q_inv = None
+        self._start_pose_t = None
 
         self._dc = None
         self._robot = None
         self._robot_dc = None
 
+        self._disable_property = None
+        self._enabled_paths = ()
+
+        # Checks to run at each phase of a 1 second tick cycle (dirty at 10Hz,
+        # collided at 1Hz), built once so ticking is a single lookup
+        checks = ((_DIRTY_PHASES, self._tick_dirty),
+                  (_COLLIDED_PHASES, self._tick_collided))
+        self._tick_schedule = tuple(
+            tuple(t for m, t in checks if (m >> i) & 1) for i in range(SIM_HZ))
+
+    def _set_start_pose(self, p):
+        # Values derived from the start pose are computed once here when the
+        # pose is placed, rather than every time they are used
+        if p is None:
+            self._start_pose = None
+            self._start_pose_q_inv = None
+            self._start_pose_t = None
+            return
+        n = np.linalg.norm(p[:4])
+        if not np.isfinite(p).all() or not n > 1e-9:
+            raise ValueError("Invalid start pose %s: values must be finite, "
+                             "with a non-zero quaternion" % p)
+        w, x, y, z = (p[:4] / n).tolist()
+        self._start_pose = p
+        self._start_pose_q_inv = (w, -x, -y, -z)
+        self._start_pose_t = tuple(p[4::].tolist())
+
+    def _tick_collided(self):
+        self.sim_collided = self.check_collided()
+
+    def _tick_dirty(self):
+        if not self.sim_dirty:
+            self.sim_dirty = self.check_dirty()
+            if self.sim_dirty:
+                os.close(os.open(DIRTY_FILE, _DIRTY_FD_FLAGS, 0o644))
+
     def check_dirty(self):
-        delta = (_to_SE3(self.start_pose).inv() *
-                 _dc_tf_to_SE3(self._dc.get_rigid_body_pose(self._robot_dc)))
-        return (np.linalg.norm(delta.t[0:2]) > DIRTY_EPSILON_DIST or
-                np.abs(delta.rpy(unit='deg')[2]) > DIRTY_EPSILON_YAW)
+        # Pose of the robot relative to its start pose, computed directly on
+        # quaternions (start pose is w,x,y,z; dynamic control is x,y,z,w)
+        tf = self._dc.get_rigid_body_pose(self._robot_dc)
+        p, r = tf.p, tf.r
+        w0, x0, y0, z0 = self._start_pose_q_inv
+        x1, y1, z1, w1 = r.x, r.y, r.z, r.w
+
+        # Translation delta rotated into the start frame (v + 2q x (q x v + wv))
+        tx, ty, tz = self._start_pose_t
+        dx, dy, dz = p.x - tx, p.y - ty, p.z - tz
+        cx = y0 * dz - z0 * dy + w0 * dx
+        cy = z0 * dx - x0 * dz + w0 * dy
+        cz = x0 * dy - y0 * dx + w0 * dz
+        if (math.hypot(dx + 2 * (y0 * cz - z0 * cy),
+                       dy + 2 * (z0 * cx - x0 * cz)) > DIRTY_EPSILON_DIST):
+            return True
+
+        # Yaw of the composed rotation q0^-1 * q1
+        w = w0 * w1 - x0 * x1 - y0 * y1 - z0 * z1
+        x = w0 * x1 + x0 * w1 + y0 * z1 - z0 * y1
+        y = w0 * y1 - x0 * z1 + y0 * w1 + z0 * x1
+        z = w0 * z1 + x0 * y1 - y0 * x1 + z0 * w1
+        yaw = math.atan2(2 * (w * z + x * y), 1 - 2 * (y * y + z * z))
+        return abs(yaw) > math.radians(DIRTY_EPSILON_YAW)
 
     def check_collided(self):
         return False
 
+    def create_server(self):
+        # Imported here so they're only loaded when the control API is used
+        import flask
+        import orjson
+        from flask.json.provider import DefaultJSONProvider
+        from gevent import pywsgi
+
+        class _OrjsonProvider(DefaultJSONProvider):
+
+            def dumps(self, obj, **kwargs):
+                return orjson.dumps(obj).decode()
+
+            def loads(self, s, **kwargs):
+                return orjson.loads(s)
+
+        f = flask.Flask('benchbot_sim_omni')
+        f.json = _OrjsonProvider(f)
+
+        @f.route('/', methods=['GET'])
+        def __hello():
+            return flask.jsonify("Hello, I am the Omniverse Sim Daemon")
+
+        @f.route('/open_environment', methods=['POST'])
+        def __open_env():
+            r = flask.request.json
+            if 'environment' in r:
+                self.map_usd = r['environment']
+            self.open_usd()
+            return flask.jsonify({})
+
+        @f.route('/place_robot', methods=['POST'])
+        def __place_robot():
+            r = flask.request.json
+            if 'robot' in r:
+                self.robot_usd = r['robot']
+            if 'start_pose' in r:
+                try:
+                    self.start_pose = _parse_pose(r['start_pose'])
+                except ValueError as e:
+                    print(e)
+                    flask.abort(400)
+            self.place_robot()
+            return flask.jsonify({})
+
+        @f.route('/restart_sim', methods=['POST'])
+        def __restart_sim():
+            self.stop_simulation()
+            self.start_simulation()
+            return flask.jsonify({})
+
+        @f.route('/start', methods=['POST'])
+        def __start_inst():
+            self.start_instance()
+            return flask.jsonify({})
+
+        @f.route('/start_sim', methods=['POST'])
+        def __start_sim():
+            self.start_simulation()
+            return flask.jsonify({})
+
+        @f.route('/started', methods=['GET'])
+        def __started():
+            # TODO note there is a race condition (returns true before a /start
+            # job finishes)
+            return flask.jsonify({'started': self.inst is not None})
+
+        @f.route('/stop_sim', methods=['POST'])
+        def __stop_sim():
+            self.stop_simulation()
+            return flask.jsonify({})
+
+        # Build the long-running server (access logging is off as it writes a
+        # line per control request; errors are still logged)
+        return pywsgi.WSGIServer(self.address, f, log=None)
+
+    def disable_component(self, enabled_path):
+        print("DISABLING '%s'" % enabled_path)
+        self._disable_property(prop_path=enabled_path)
+
     def open_usd(self):
         # Bail early if we can't act
         if self.inst is None:
@@ -107,7 +267,7 @@ class SimulatorDaemon:
         # Update the map
         if self.map_usd != self._map_usd:
             self._dc = None
-            self._start_pose = None
+            self._set_start_pose(None)
             self._robot = None
             self._robot_dc = None
             self._robot_usd = None
@@ -137,6 +297,7 @@ class SimulatorDaemon:
         from omni.isaac.core.robots import Robot
         from omni.isaac.core.utils.stage import (add_reference_to_stage,
                                                  update_stage)
+        from omni.kit.undo import group as undo_group
 
         # Stop simulation if running
         self.stop_simulation()
@@ -152,89 +313,76 @@ class SimulatorDaemon:
         else:
             print("Skipping robot load; already loaded.")
 
-        if (p != self._start_pose).any():
-            self._robot.set_world_pose(position=p[4::],
-                                       orientation=p[:4])
+        if (self._start_pose is None or
+                not np.array_equal(p, self._start_pose)):
+            self._robot.set_world_pose(position=p[4::], orientation=p[:4])
             update_stage()
-            self._start_pose = p
+            self._set_start_pose(p)
         else:
             print("Skipping robot move; already at requested pose.")
 
-        # Disable auto-publishing of all robot components (we'll manually
-        # publish at varying frequencies instead)
-        for p in ROBOT_COMPONENTS.values():
-            disable_component(p)
+        # Disable the robot's own ROS bridge components (publishing is driven
+        # by the action graph on sim.step()), as a single undo transaction
+        with undo_group():
+            for p in self._enabled_paths:
+                self.disable_component(p)
 
         # Attempt to start the simulation
         self.start_simulation()
 
     def run(self):
-        f = flask.Flask('benchbot_sim_omni')
+        # The control API is only built when enabled (default); otherwise the
+        # environment, robot, & start pose come from environment variables and
+        # the simulation is started directly
+        server = None
+        if _env_flag('BENCHBOT_CONTROL', True):
+            server = self.create_server()
+        else:
+            self.map_usd = os.environ.get('BENCHBOT_ENVIRONMENT')
+            self.robot_usd = os.environ.get('BENCHBOT_ROBOT')
+            if self.map_usd is None or self.robot_usd is None:
+                raise ValueError("BENCHBOT_ENVIRONMENT and BENCHBOT_ROBOT must "
+                                 "be set when BENCHBOT_CONTROL is disabled")
+            if 'BENCHBOT_START_POSE' in os.environ:
+                self.start_pose = _parse_pose(
+                    os.environ['BENCHBOT_START_POSE'])
 
-        @f.route('/', methods=['GET'])
-        def __hello():
-            return flask.jsonify("Hello, I am the Omniverse Sim Daemon")
+        evt = event.Event()
 
-        @f.route('/open_environment', methods=['POST'])
-        def __open_env():
-            r = flask.request.json
-            if 'environment' in r:
-                self.map_usd = r['environment']
-            self.open_usd()
-            return flask.jsonify({})
+        def __handle_signal(n, frame):
+            evt.set()
 
-        @f.route('/place_robot', methods=['POST'])
-        def __place_robot():
-            r = flask.request.json
-            if 'robot' in r:
-                self.robot_usd = r['robot']
-            if 'start_pose' in r:
-                # Probably should be regexing...
-                self.start_pose = np.array([
-                    float(x.strip()) for x in r['start_pose'].replace(
-                        '[', '').replace(']', '').split(',')
-                ])
-            self.place_robot()
-            return flask.jsonify({})
+        def __handle_quit(n, frame):
+            # Hard exit, skipping the (slow) simulator shutdown
+            faulthandler.dump_traceback()
+            os._exit(1)
 
-        @f.route('/restart_sim', methods=['POST'])
-        def __restart_sim():
-            self.stop_simulation()
-            self.start_simulation()
-            return flask.jsonify({})
+        for s in (signal.SIGINT, signal.SIGTERM):
+            gsignal.signal(s, __handle_signal)
+        gsignal.signal(signal.SIGQUIT, __handle_quit)
 
-        @f.route('/start', methods=['POST'])
-        def __start_inst():
+        if server is None:
+            # Opens the environment & places the robot, as map_usd is set
+            print("Control API disabled. Starting '%s' with robot '%s'." %
+                  (self.map_usd, self.robot_usd))
             self.start_instance()
-            return flask.jsonify({})
-
-        @f.route('/start_sim', methods=['POST'])
-        def __start_sim():
-            self.start_simulation()
-            return flask.jsonify({})
-
-        @f.route('/started', methods=['GET'])
-        def __started():
-            # TODO note there is a race condition (returns true before a /start
-            # job finishes)
-            return flask.jsonify({'started': self.inst is not None})
-
-        @f.route('/stop_sim', methods=['POST'])
-        def __stop_sim():
-            self.stop_simulation()
-            return flask.jsonify({})
+        else:
+            server.start()
 
-        # Start long-running server
-        server = pywsgi.WSGIServer(self.address, f)
-        evt = event.Event()
-        for s in [signal.SIGINT, signal.SIGQUIT, signal.SIGTERM]:
-            signal.signal(s, lambda n, frame: evt.set())
-        
-        server.start()
-        
+        # Tick at SIM_HZ against a monotonic deadline, yielding to the server
+        # for whatever time remains in each period
+        period = 1.0 / SIM_HZ
+        next_t = time.monotonic()
         while not evt.is_set():
-            evt.wait(0.001)
             self.tick_simulator()
+            next_t += period
+            dt = next_t - time.monotonic()
+            if dt > 0:
+                evt.wait(dt)
+            else:
+                # Running behind; reset the deadline but still yield
+                next_t = time.monotonic()
+                evt.wait(0)
 
         # Cleanup
         self.stop_instance()
@@ -277,6 +425,16 @@ class SimulatorDaemon:
         from omni.isaac.core.utils.extensions import enable_extension
         enable_extension("omni.isaac.ros_bridge")
 
+        # Bind commands used repeatedly once the app is up
+        from omni.kit.commands import execute
+        from pxr import Sdf
+        self._disable_property = functools.partial(execute,
+                                                   "ChangeProperty",
+                                                   value=False,
+                                                   prev=None)
+        self._enabled_paths = tuple(
+            Sdf.Path("%s.enabled" % p) for p in _ROBOT_COMPONENT_PATHS)
+
         #ext_manager = omni.kit.app.get_app().get_extension_manager()
         #self.inst.set_setting("/app/window/drawMouse", True)
         #self.inst.set_setting("/app/livestream/proto", "ws")
@@ -349,26 +507,25 @@ class SimulatorDaemon:
 
     def tick_simulator(self):
         # Tick simulator steps. Does less now than in 2021.2.1 due to new action graph
-        if self.inst is None:
+        # ROS publishing happens within sim.step().
+        inst = self.inst
+        if inst is None:
             return
-        if self.sim is None:
-            self.inst.update()
+        sim = self.sim
+        if sim is None:
+            inst.update()
             return
 
-        self.sim.step()
-
-        # Tick at 10Hz CHECK DIRTY
-        if self.sim_i % 6 == 0:
-            if not self.sim_dirty:
-                self.sim_dirty = self.check_dirty()
-                if self.sim_dirty:
-                    Path(DIRTY_FILE).touch()
+        sim.step()
 
-        # Tick at 1Hz CHECK COLLIDED
-        if self.sim_i % 60 == 0:
-            self.sim_collided = self.check_collided()
+        # Run the checks scheduled for this phase of the tick cycle
+        i = self.sim_i
+        for t in self._tick_schedule[i]:
+            t()
 
-        self.sim_i += 1
+        # Every check rate divides SIM_HZ, so the counter only needs to cover
+        # one cycle
+        self.sim_i = (i + 1) % SIM_HZ
 
 
 if __name__ == '__main__':